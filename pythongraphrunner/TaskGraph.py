@@ -1,8 +1,26 @@
 # Defines the utilities needed for a task graph
-from typing import Generic, TypeVar, Set, Callable, Optional, Dict, List, Tuple
-import uuid
+from typing import Generic, TypeVar, Set, FrozenSet, Callable, Optional, Deque, Dict, List, Tuple
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+import sys
+import threading
 
-import networkx as nx
+# Counters for ids that aren't provided by
+# the caller. These are only unique within
+# a process; pass explicit ids if you need
+# them to be unique across processes
+_itemIDCounter = count()
+_edgeIDCounter = count()
+
+def _intern(state : str) -> str:
+  """
+  Interns a state if it's a plain str.
+  sys.intern rejects subclasses, like
+  str enums, so those pass through
+  unchanged
+  """
+  return sys.intern(state) if type(state) is str else state
 
 class ItemBase:
   """
@@ -10,37 +28,43 @@ class ItemBase:
   class for all object
   instances that interact
   with a task graph.
-  Mainly, it defines setters
-  for the current and desired
-  states, and provides
-  some other utilities
+  Mainly, it holds the current
+  and desired states, and
+  provides some other utilities.
+  currState is a plain attribute,
+  since the graph reads and writes
+  it on every transition. The
+  desired state is interned when
+  set, so the graph's compares
+  can short-circuit on identity.
+  If no id is passed, one of the
+  form item-N is generated, unique
+  within this process, so avoid
+  passing explicit ids of that form
   """
+  # Slots keep per-item memory down when
+  # a graph holds a large number of items
+  __slots__ = ('currState', '_desiredState', '_id')
+
   def __init__(self, currState : str, desiredState : str, id : Optional[str]):
-    self.__currState = currState
-    self.__desiredState = desiredState
+    self.currState : str = _intern(currState)
+    self._desiredState = _intern(desiredState)
 
     # Set the id based on if
     # the optinal is set or not
-    self.__id : str = id if id is not None else uuid.uuid4().hex
+    self._id : str = id if id is not None else f"item-{next(_itemIDCounter)}"
   
   # Getters and setters
-  @property
-  def currState(self) -> str:
-    return self.__currState
-  @currState.setter
-  def currState(self, newState : str):
-    self.__currState = newState
-  
   @property
   def desiredState(self) -> str:
-    return self.__desiredState
+    return self._desiredState
   @desiredState.setter
   def desiredState(self, newState : str):
-    self.__desiredState = newState
+    self._desiredState = _intern(newState)
   
   @property
   def id(self) -> str:
-    return self.__id
+    return self._id
   
   @property
   def isDiscrepant(self) -> bool:
@@ -67,36 +91,30 @@ class TaskEdge(Generic[T]):
     from trying to use these, but are used internally
     to enforce a valid response if an error condition
     is met
+  :params id: An optional id for the edge. If not set,
+    one of the form edge-N is generated, unique within
+    this process, so avoid passing explicit ids of
+    that form
   """
+  __slots__ = ('startStates', 'endStates', 'errorEndStates', 'runner', '_id', '_validOutputs', '_singleValid')
+
   def __init__(self, startStates : List[str], endStates : List[str], errorEndStates : List[str], runner : Callable[ [T], str], id : Optional[str] = None):
-    self._startStates = startStates
-    self._endStates = endStates
-    self._errorEndStates = errorEndStates
-    self._runner = runner
+    self.startStates : List[str] = [ _intern(state) for state in startStates ]
+    self.endStates : List[str] = [ _intern(state) for state in endStates ]
+    self.errorEndStates : List[str] = [ _intern(state) for state in errorEndStates ]
+    self.runner : Callable[ [T], str] = runner
 
-    self._id : str = id if id is not None else uuid.uuid4().hex
+    self._id : str = id if id is not None else f"edge-{next(_edgeIDCounter)}"
 
     # A set for valid outputs
-    self._validOutputs : Set[str] = set( self._endStates + self._errorEndStates )
-  
-  # Getters for states
-  @property
-  def startStates(self) -> List[str]:
-    return self._startStates
-  
-  @property
-  def endStates(self) -> List[str]:
-    return self._endStates
-
-  @property
-  def errorEndStates(self) -> List[str]:
-    return self._errorEndStates
-
-  # Getters for the id and runner
-  @property
-  def runner(self) -> Callable[ [T], str]:
-    return self._runner
+    self._validOutputs : FrozenSet[str] = frozenset( self.endStates + self.errorEndStates )
 
+    # If there's only one valid output,
+    # keep it around so we can validate
+    # with a single compare
+    self._singleValid : Optional[str] = self.endStates[0] if len(self.endStates) == 1 and not self.errorEndStates else None
+  
+  # Getter for the id
   @property
   def id(self) -> str:
     return self._id
@@ -105,76 +123,138 @@ class TaskEdge(Generic[T]):
     """
     Calls the internal runner,
     and verifies we exit into a valid
-    state.
+    state. Plain str states are
+    returned interned
     """
-    outState = self._runner(o)
+    outState = self.runner(o)
+
+    singleValid = self._singleValid
+    if singleValid is not None:
+      if outState != singleValid:
+        raise ValueError(f"Invalid output state {outState}!")
+      
+      # Return our own copy, which is already
+      # interned if it's a plain str
+      return singleValid
 
     if outState not in self._validOutputs:
       raise ValueError(f"Invalid output state {outState}!")
     else:
-      return outState
+      return _intern(outState)
 
 class TaskGraph(Generic[T]):
   """
   Represents a task graph. In here
-  is a networkx graph, where each state
+  is a directed graph, where each state
   is a node, and each edge has a callable
   that transitions between states
   """
   def __init__(self):
-    # Constructing our graph
-    self._graph = nx.DiGraph()
-    
     # Contains a set of states we allow
     self._states : Set[str] = set()
 
+    # Flat adjacency for transitions: maps each
+    # start state to the states it leads to, and
+    # each of those to the edge that gets there
+    self._adj : Dict[ str, Dict[str, TaskEdge[T]] ] = {}
+
+    # Reverse adjacency used by the planner: maps
+    # each state to the states leading into it
+    self._pred : Dict[ str, List[str] ] = {}
+
     # For right now, I'll expirement with the task
     # graph owning the items. Will see if this works
     self._items : Dict[str, T] = {}
 
     # Maintains a set of discrepant items
     self._discrepantItems : Set[str] = set()
+
+    # Memoizes planned transitions along shortest
+    # paths, as (edge, expected end state) pairs,
+    # keyed by (startState, desiredState). Cleared
+    # whenever the graph changes
+    self._planCache : Dict[ Tuple[str, str], Tuple[ Tuple[TaskEdge[T], str], ... ] ] = {}
+
+    # For each desired state, maps every state
+    # found to reach it to the next state on a
+    # shortest path towards it. Built by a single
+    # reverse BFS per desired state, which only
+    # explores as far as planning has needed so
+    # far; its frontier is kept to resume from
+    self._nextHops : Dict[ str, Dict[str, Optional[str]] ] = {}
+    self._frontiers : Dict[ str, Deque[str] ] = {}
+
+    # Guards the planning caches, since items
+    # being fixed on worker threads may need
+    # to re-plan after a deviation
+    self._planLock = threading.Lock()
+
+    # Set when every state leads to at most one
+    # other state. In that case _next maps each
+    # state to the only edge leaving it, and
+    # fixItems just follows the chain instead
+    # of planning. Recomputed lazily after the
+    # graph changes
+    self._shapeDirty : bool = True
+    self._isLinear : bool = False
+    self._next : Dict[str, TaskEdge[T]] = {}
+
+    # Set when the states form a DAG, in which
+    # case _topoIdx holds each state's position
+    # in a topological order. A state can only
+    # reach states after it, which lets the
+    # planner reject impossible pairs without
+    # searching. Recomputed alongside the above
+    self._isDag : bool = False
+    self._topoIdx : Dict[str, int] = {}
     
   def addState(self, stateName : str):
     """
     Adds a state to the graph
     """
-    self._states.add(stateName)
-    self._graph.add_node(stateName)
+    self.addStates([stateName])
   
   def addStates(self, stateNames : List[str]):
     """
     Adds a list of states to the graph
     """
-    for stateName in stateNames:
-      self.addState(stateName)
+    self._states.update( _intern(stateName) for stateName in stateNames )
+    self._invalidatePaths()
     
   def addEdge(self, taskEdge : TaskEdge[T]):
     """
     Adds an edge to the graph
     """
-    # Check if the states are valid
-    for state in taskEdge.startStates + taskEdge.endStates + taskEdge.errorEndStates:
-      if state not in self._states:
-        raise ValueError(f"State {state} is not in the graph!")
-    
-    # Add the edge, as a node
-    self._graph.add_node(taskEdge.id, edgeObj = taskEdge)
-
-    # Add all edges to the node that aren't error edges
-    for startState in taskEdge.startStates:
-      self._graph.add_edge(startState, taskEdge.id)
-    
-    # Add all end states to the node
-    for endState in taskEdge.endStates:
-      self._graph.add_edge(taskEdge.id, endState)
+    self.addEdges([taskEdge])
   
   def addEdges(self, taskEdges : List[TaskEdge[T]]):
     """
-    Adds a list of edges to the graph
+    Adds a list of edges to the graph. All
+    edges are validated before any is added
     """
+    # Check if the states are valid, reporting
+    # every missing one at once
+    missing : Set[str] = set()
     for taskEdge in taskEdges:
-      self.addEdge(taskEdge)
+      missing.update(taskEdge.startStates, taskEdge.endStates, taskEdge.errorEndStates)
+    missing -= self._states
+    if missing:
+      raise ValueError(f"States {sorted(missing)} are not in the graph!")
+    
+    # Link every start state directly to every
+    # end state through each edge. Error end
+    # states are left out so the planner never
+    # routes through them. If an earlier edge
+    # already links a pair, it keeps handling it
+    for taskEdge in taskEdges:
+      for startState in taskEdge.startStates:
+        nextStates = self._adj.setdefault(startState, {})
+        for endState in taskEdge.endStates:
+          if endState not in nextStates:
+            nextStates[endState] = taskEdge
+            self._pred.setdefault(endState, []).append(startState)
+
+    self._invalidatePaths()
   
   def addItem(self, item : T):
     """
@@ -224,64 +304,291 @@ class TaskGraph(Generic[T]):
     return list(self._items.items())
   
   def updateItemStates(self, itemID : str, currState : str, desiredState : str):
-    if itemID not in self._items:
+    item = self._items.get(itemID)
+    if item is None:
       raise ValueError(f"Item with id {itemID} is not in the graph!")
   
-    # Update the item's states
-    self._items[itemID].currState = currState
-    self._items[itemID].desiredState = desiredState
+    # Update the item's states, interning
+    # them like the setters would
+    currState = _intern(currState)
+    desiredState = _intern(desiredState)
+    item.currState = currState
+    item._desiredState = desiredState
 
-    # Check if the item is discrepant, and
-    # add it to the set if needed
-    if self._items[itemID].isDiscrepant and itemID not in self._discrepantItems:
+    # Add or remove the item from the
+    # discrepant set as needed
+    if currState != desiredState:
       self._discrepantItems.add(itemID)
-    elif not self._items[itemID].isDiscrepant and itemID in self._discrepantItems:
-      self._discrepantItems.remove(itemID)
-  
-  def fixItems(self):
+    else:
+      self._discrepantItems.discard(itemID)
+
+  def _invalidatePaths(self):
+    """
+    Drops all memoized planning data,
+    called whenever the graph changes
+    """
+    self._planCache.clear()
+    self._nextHops.clear()
+    self._frontiers.clear()
+    self._shapeDirty = True
+
+  def _analyzeShape(self):
+    """
+    Checks whether the graph is a set of
+    linear chains, and if so builds the
+    state to next edge table. Also checks
+    whether it's acyclic, and if so
+    topologically orders the states
+    """
+    if not self._shapeDirty:
+      return
+
+    self._isLinear = all( len(nextStates) <= 1 for nextStates in self._adj.values() )
+    self._next = {
+      state : edge for state, nextStates in self._adj.items() for edge in nextStates.values()
+    } if self._isLinear else {}
+
+    # Kahn's algorithm over the states
+    inDegree : Dict[str, int] = { state : 0 for state in self._states }
+    for nextStates in self._adj.values():
+      for nextState in nextStates:
+        inDegree[nextState] += 1
+
+    order : List[str] = [ state for state, degree in inDegree.items() if degree == 0 ]
+    for state in order:
+      for nextState in self._adj.get(state, ()):
+        inDegree[nextState] -= 1
+        if inDegree[nextState] == 0:
+          order.append(nextState)
+
+    self._isDag = len(order) == len(self._states)
+    self._topoIdx = { state : idx for idx, state in enumerate(order) } if self._isDag else {}
+    self._shapeDirty = False
+
+  def _nextHopsTowards(self, endState : str, startState : str) -> Dict[str, Optional[str]]:
+    """
+    Grows the reverse BFS from the given end
+    state until it reaches the start state,
+    or runs out of states, and returns the map
+    from every state found so far to the next
+    state on a shortest path towards the end
+    state. The search is resumed, not redone,
+    for later start states, until the graph
+    changes
+    """
+    nextHops = self._nextHops.get(endState)
+    if nextHops is None:
+      if endState not in self._states:
+        raise ValueError(f"State {endState} is not in the graph!")
+
+      nextHops = self._nextHops[endState] = { endState : None }
+      self._frontiers[endState] = deque([endState])
+
+    pred = self._pred
+    frontier = self._frontiers[endState]
+
+    # Only stop between states, so a resumed
+    # search never skips predecessors of a
+    # state that was already popped
+    while startState not in nextHops and frontier:
+      node = frontier.popleft()
+      for prevNode in pred.get(node, ()):
+        if prevNode not in nextHops:
+          nextHops[prevNode] = node
+          frontier.append(prevNode)
+    
+    return nextHops
+
+  def _plan(self, startState : str, endState : str) -> Tuple[ Tuple[TaskEdge[T], str], ... ]:
+    """
+    Returns the transitions along the shortest
+    path between two states, as (edge, expected
+    end state) pairs, memoized until the graph
+    changes. The plan is a tuple so callers
+    can't mutate the cached copy
+    """
+    try:
+      return self._planCache[(startState, endState)]
+    except KeyError:
+      pass
+
+    with self._planLock:
+      return self._computePlan(startState, endState)
+
+  def _computePlan(self, startState : str, endState : str) -> Tuple[ Tuple[TaskEdge[T], str], ... ]:
+    """
+    Computes and memoizes the transitions
+    along the shortest path between two
+    states. Must be called with the plan
+    lock held
+    """
+    # Another thread may have planned
+    # this while we waited for the lock
+    if (startState, endState) in self._planCache:
+      return self._planCache[(startState, endState)]
+
+    if startState not in self._states:
+      raise ValueError(f"State {startState} is not in the graph!")
+
+    # On a DAG, a state can't reach anything
+    # before it in topological order
+    if not self._shapeDirty and self._isDag and endState in self._topoIdx and self._topoIdx[startState] > self._topoIdx[endState]:
+      raise ValueError(f"No path between {startState} and {endState}!")
+
+    nextHops = self._nextHopsTowards(endState, startState)
+    if startState not in nextHops:
+      raise ValueError(f"No path between {startState} and {endState}!")
+
+    # Walk the next hops until we hit the
+    # desired state, resolving the edge to
+    # run for each hop as we go
+    adj = self._adj
+    steps : List[ Tuple[TaskEdge[T], str] ] = []
+    state = startState
+    node = nextHops[startState]
+    while node is not None:
+      steps.append( (adj[state][node], node) )
+      state = node
+      node = nextHops[node]
+
+    plan = tuple(steps)
+    self._planCache[(startState, endState)] = plan
+    return plan
+
+  def _checkChain(self, startState : str, endState : str):
+    """
+    On a linear graph, verifies that following
+    the chain from the start state reaches the
+    desired state, before any runner is called
+    """
+    for state in (startState, endState):
+      if state not in self._states:
+        raise ValueError(f"State {state} is not in the graph!")
+
+    seen : Set[str] = set()
+    state = startState
+    while state != endState:
+      if state in seen or state not in self._next:
+        raise ValueError(f"No path between {startState} and {endState}!")
+      seen.add(state)
+      state = next(iter(self._adj[state]))
+
+  def _walkChain(self, item : T):
+    """
+    On a linear graph, moves an item to its
+    desired state by running the only edge
+    leaving each state it passes through.
+    The chain from the item's current state
+    must already have been checked
+    """
+    # Track the state in locals,
+    # only writing it back to the item
+    adj = self._adj
+    nextEdges = self._next
+    endState = item._desiredState
+    currState = item.currState
+
+    while currState != endState:
+      expectedState = next(iter(adj[currState]))
+      currState = nextEdges[currState](item)
+      item.currState = currState
+
+      # A deviation, e.g. into an error end state,
+      # may have left the chain. Make sure we can
+      # still get to the desired state before
+      # running anything else, like the planner does
+      if currState != expectedState:
+        self._checkChain(currState, endState)
+
+  def _driveItem(self, item : T, plan : Tuple[ Tuple[TaskEdge[T], str], ... ]):
+    """
+    Runs an item's planned transitions,
+    re-planning whenever one lands
+    somewhere unexpected
+    """
+    endState = item._desiredState
+
+    while True:
+      for edge, expectedState in plan:
+        nextState = edge(item)
+
+        # Set the item's curr state
+        item.currState = nextState
+
+        # If the state we enter into, which is the
+        # return value from the edge's callable, is
+        # not what we expect, a deviation has occurred.
+        # In this case, re-plan from the state we actually
+        # ended up in, and re-run
+        if nextState != expectedState:
+          plan = self._plan(nextState, endState)
+          break
+      else:
+        # Every transition went as planned, so
+        # we're at the desired state
+        return
+
+  def _fixItem(self, item : T, plan : Optional[ Tuple[ Tuple[TaskEdge[T], str], ... ] ]):
+    """
+    Runs an item's transitions, following
+    the chain on linear graphs and the
+    plan otherwise
+    """
+    if plan is None:
+      self._walkChain(item)
+    else:
+      self._driveItem(item, plan)
+
+  def fixItems(self, maxWorkers : int = 1):
     """
     For all discrepant items, run the
     appropriate transition
+
+    :params maxWorkers: The number of threads to run
+      items' transitions on. Items are independent, so
+      with IO-bound runners a value above 1 lets them
+      run concurrently. Planning always happens on the
+      calling thread; with the default of 1, everything
+      runs there too
     """
+    self._analyzeShape()
+
+    # Group items by their (current, desired) state
+    # pair, so we only plan once per pair. The reverse
+    # BFS trees are shared between all groups heading
+    # to the same desired state
+    groups : Dict[ Tuple[str, str], List[T] ] = defaultdict(list)
     for itemID in self._discrepantItems:
-      # Get the item
       item = self._items[itemID]
-      startState = item.currState
-      endState = item.desiredState
-      
-      # Determine the shortest path between
-      # the current state and desired
-      path : list = list(nx.shortest_path( self._graph, startState, endState))
-
-      # The index we're currently at. If
-      # the state we enter into, which
-      # is the return value from the
-      # edge's callable, is not what we
-      # expect, a deviation has occurred.
-      # In this case, re-compute path and re-run
-      idx = 1
-      
-      # We go till len(path) - 1 since the last
-      # state, which is the terminal state, is
-      # where we are aiming to enter. It doens't make
-      # sense to keep on running transitions
-      # after we've hit the destination. In that case,
-      # change the destination to where you actually
-      # want to go
-      while idx < len(path) - 1:
-        nextState = self._graph.nodes[path[idx]]["edgeObj"] (item)
+      groups[(item.currState, item._desiredState)].append(item)
 
-        # Set the item's curr state
-        item.currState = nextState
+    # Plan everything up front, so we fail before
+    # running anything if some item can't get
+    # to where it wants to be
+    work : List[ Tuple[T, Optional[ Tuple[ Tuple[TaskEdge[T], str], ... ] ]] ] = []
+    for (startState, endState), items in groups.items():
+      if self._isLinear:
+        # No planning needed, just make sure the
+        # chain actually leads where we want
+        self._checkChain(startState, endState)
+        plan = None
+      else:
+        # Plan the transitions along the shortest
+        # path between the current state and desired
+        plan = self._plan(startState, endState)
+
+      work.extend( (item, plan) for item in items )
 
-        if nextState == path[idx + 1]:
-          # In this branch, the transition was
-          # as planned
-          idx += 2
-        else:
-          # Transition went differently, re-run djkstra's, and
-          # set idx to 1
-          idx -= idx + 1
-
-          path.clear()
-          path = path + list(nx.shortest_path( self._graph, startState, endState ))
\ No newline at end of file
+    try:
+      if maxWorkers == 1:
+        for item, plan in work:
+          self._fixItem(item, plan)
+      else:
+        with ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+          list(executor.map(lambda itemPlan: self._fixItem(*itemPlan), work))
+    finally:
+      # Items that are where they want to be
+      # now shouldn't be tracked as discrepant
+      for item, _ in work:
+        if not item.isDiscrepant:
+          self._discrepantItems.discard(item.id)